@@ -6,8 +6,17 @@ import pandas as pd
 from datetime import datetime
 import json
 import logging
+import math
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+# 超過此大小的請求在解析表單前即由 Flask 回傳 413
+app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024
 
 logging.basicConfig(filename='app.log', level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s: %(message)s')
@@ -17,6 +26,14 @@ if not os.path.exists(os.path.join(BASE_DIR, "data")):
     os.makedirs(os.path.join(BASE_DIR, "data"))
 DB_PATH = os.path.join(BASE_DIR, "data", "database.db")
 GROUPS_FILE = os.path.join(BASE_DIR, "data", "groups.json")
+# 管理頁面與報表只讀取定期更新的快照，避免與學生投票的寫入互搶鎖與快取
+SNAPSHOT_PATH = os.path.join(BASE_DIR, "data", "snapshot.db")
+SNAPSHOT_REFRESH_SECONDS = 30
+SNAPSHOT_POOL_SIZE = 4
+# 下載最終結果時，快照超過此秒數就先即時更新，避免漏掉剛投下的票
+DOWNLOAD_SNAPSHOT_MAX_AGE_SECONDS = 2
+# 快照仍有讀取中的查詢時備份會一直重試，超過此秒數即放棄並記錄錯誤
+SNAPSHOT_BACKUP_TIMEOUT_SECONDS = 5
 
 def login_required(route_func):
     def wrapper(*args, **kwargs):
@@ -27,6 +44,95 @@ def login_required(route_func):
     wrapper.__name__ = route_func.__name__
     return wrapper
 
+# 每個路由的學號 token bucket 預算: (桶容量, 每秒補充的 token 數)
+RATE_LIMITS = {
+    "vote": (10, 1.0),
+    "confirm_vote": (5, 0.2),
+    "toggle_vote": (20, 2.0),
+    "submit_feedback": (10, 0.5),
+    "batch_feedback": (5, 0.2),
+}
+# 每個路由的 IP 預算。/submit 可任意建立新學號，因此 IP 才是真正的防線；
+# 只有前端實際會呼叫的登入、確認投票與送出回饋需容納整間教室共用同一個 IP
+IP_RATE_LIMITS = {
+    "submit": (300, 5.0),
+    "vote": (20, 2.0),
+    "confirm_vote": (300, 5.0),
+    "toggle_vote": (40, 4.0),
+    "submit_feedback": (20, 1.0),
+    "batch_feedback": (300, 5.0),
+}
+# 需大於 桶容量 / 補充速率，被清除的桶才等同於已補滿
+RATE_LIMIT_IDLE_SECONDS = 600
+MAX_BATCH_FEEDBACKS = 100
+BATCH_FEEDBACK_KEYS = {"groupId", "feedback", "feedbackDate", "feedbackTime"}
+MAX_BATCH_FEEDBACK_BYTES = 64 * 1024
+
+class TokenBucketLimiter:
+    def __init__(self, idle_seconds):
+        self.idle_seconds = idle_seconds
+        self.buckets = OrderedDict()  # key -> (tokens, last_seen)，依最後使用時間排序
+        self.lock = threading.Lock()
+
+    def consume(self, budgets):
+        """budgets 為 (key, 桶容量, 補充速率) 的列表；全部桶都有 token 時才一起扣除。
+        允許時回傳 0，否則回傳需等待的秒數，且不扣除任何桶。"""
+        now = time.monotonic()
+        with self.lock:
+            self._evict_idle(now)
+            refilled = []
+            wait = 0
+            for key, capacity, rate in budgets:
+                bucket = self.buckets.pop(key, None)
+                if bucket is None:
+                    tokens = capacity
+                else:
+                    tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                refilled.append((key, tokens))
+            for key, tokens in refilled:
+                self.buckets[key] = (tokens if wait > 0 else tokens - 1, now)
+            return wait
+
+    def _evict_idle(self, now):
+        while self.buckets:
+            key, (_, last_seen) = next(iter(self.buckets.items()))
+            if now - last_seen < self.idle_seconds:
+                break
+            del self.buckets[key]
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_IDLE_SECONDS)
+
+def rate_limit_wait(route_name):
+    """依學號與 IP 預算檢查是否允許本次請求；回傳需等待的秒數，0 表示允許。"""
+    student_id = session.get("student_id")
+    client_ip = request.remote_addr or "unknown"
+    budgets = [(("ip", route_name, client_ip),) + IP_RATE_LIMITS[route_name]]
+    if student_id and route_name in RATE_LIMITS:
+        budgets.append((("student", route_name, student_id),) + RATE_LIMITS[route_name])
+    wait = rate_limiter.consume(budgets)
+    if wait > 0:
+        logging.warning(f"Rate limit exceeded: route={request.path}, student={student_id}, ip={client_ip}")
+    return wait
+
+def rate_limited(route_func):
+    def wrapper(*args, **kwargs):
+        wait = rate_limit_wait(route_func.__name__)
+        if wait > 0:
+            response = jsonify({"success": False, "message": "操作過於頻繁，請稍後再試"})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(math.ceil(wait))
+            return response
+        return route_func(*args, **kwargs)
+    wrapper.__name__ = route_func.__name__
+    return wrapper
+
+@app.errorhandler(413)
+def request_too_large(e):
+    logging.warning(f"Request too large: path={request.path}, size={request.content_length}")
+    return jsonify({"success": False, "message": "請求資料過大"}), 413
+
 def init_db():
     try:
         with sqlite3.connect(DB_PATH) as conn:
@@ -176,11 +282,62 @@ def check_database():
     except sqlite3.Error as e:
         logging.error(f"Error checking database: {e}")
 
+snapshot_refreshed_at = None
+snapshot_pool = queue.LifoQueue(maxsize=SNAPSHOT_POOL_SIZE)
+snapshot_lock = threading.Lock()
+
+def refresh_snapshot(max_age=None):
+    global snapshot_refreshed_at
+    with snapshot_lock:
+        age = snapshot_age()
+        if max_age is not None and age is not None and age <= max_age:
+            return
+        deadline = time.monotonic() + SNAPSHOT_BACKUP_TIMEOUT_SECONDS
+
+        def check_deadline(status, remaining, total):
+            if time.monotonic() > deadline:
+                raise sqlite3.OperationalError("snapshot backup timed out")
+
+        try:
+            with sqlite3.connect(DB_PATH) as src, sqlite3.connect(SNAPSHOT_PATH, timeout=0.1) as dst:
+                src.backup(dst, progress=check_deadline)
+            snapshot_refreshed_at = time.time()
+            logging.debug("Snapshot database refreshed.")
+        except sqlite3.Error as e:
+            logging.error(f"Error refreshing snapshot database: {e}")
+
+def snapshot_refresher():
+    while True:
+        time.sleep(SNAPSHOT_REFRESH_SECONDS)
+        refresh_snapshot()
+
+def snapshot_age():
+    if snapshot_refreshed_at is None:
+        return None
+    return int(time.time() - snapshot_refreshed_at)
+
+@contextmanager
+def snapshot_connection():
+    try:
+        conn = snapshot_pool.get_nowait()
+    except queue.Empty:
+        conn = sqlite3.connect(Path(SNAPSHOT_PATH).as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+    try:
+        yield conn
+    finally:
+        try:
+            snapshot_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
 init_db()
 sync_groups()
 migrate_feedbacks_table()
 update_feedbacks_table()
 check_database()
+refresh_snapshot()
+threading.Thread(target=snapshot_refresher, daemon=True).start()
 
 def get_votes_by_student(student_id):
     try:
@@ -209,6 +366,12 @@ def index():
 
 @app.route("/submit", methods=["POST"])
 def submit():
+    wait = rate_limit_wait("submit")
+    if wait > 0:
+        response = make_response(render_template("index.html", message="登入過於頻繁，請稍後再試。"), 429)
+        response.headers["Retry-After"] = str(math.ceil(wait))
+        return response
+
     student_id = request.form.get("student_id")
     student_name = request.form.get("student_name")
     student_class = request.form.get("student_class")
@@ -268,6 +431,7 @@ def vote_page():
 
 @app.route("/api/vote", methods=["POST"])
 @login_required
+@rate_limited
 def vote():
     student_id = session.get("student_id")
     data = request.get_json()
@@ -300,6 +464,7 @@ def vote():
 
 @app.route("/api/vote/confirm", methods=["POST"])
 @login_required
+@rate_limited
 def confirm_vote():
     student_id = session.get("student_id")
     data = request.get_json()
@@ -334,6 +499,7 @@ def confirm_vote():
 
 @app.route("/api/toggle_vote", methods=["POST"])
 @login_required
+@rate_limited
 def toggle_vote():
     student_id = session.get("student_id")
     data = request.get_json()
@@ -386,6 +552,7 @@ def feedbacks():
 
 @app.route("/api/feedback", methods=["POST"])
 @login_required
+@rate_limited
 def submit_feedback():
     student_id = session.get("student_id")
     feedback = request.form.get("feedback", "").strip()
@@ -421,8 +588,16 @@ def submit_feedback():
 
 @app.route("/api/feedback/batch", methods=["POST"])
 @login_required
+@rate_limited
 def batch_feedback():
     student_id = session.get("student_id")
+    if request.content_length is None:
+        logging.warning(f"Batch feedback without Content-Length: student={student_id}")
+        return jsonify({"success": False, "message": "缺少 Content-Length"}), 411
+    if request.content_length > MAX_BATCH_FEEDBACK_BYTES:
+        logging.warning(f"Batch feedback too large: student={student_id}, size={request.content_length}")
+        return jsonify({"success": False, "message": "回饋資料過大"}), 413
+
     feedback_data = request.form.get("data")
     if not feedback_data:
         logging.info(f"No feedback data received for student {student_id}. Allowing empty submission.")
@@ -430,11 +605,17 @@ def batch_feedback():
 
     try:
         feedbacks = json.loads(feedback_data)
-        logging.info(f"Received batch feedback: student={student_id}, count={len(feedbacks)}")
     except json.JSONDecodeError:
         logging.error("Invalid JSON in batch feedback data.")
         return jsonify({"success": False, "message": "回饋資料格式錯誤"}), 400
 
+    if (not isinstance(feedbacks, list) or len(feedbacks) > MAX_BATCH_FEEDBACKS
+            or not all(isinstance(f, dict) and all(isinstance(f.get(k), str) for k in BATCH_FEEDBACK_KEYS)
+                       for f in feedbacks)):
+        logging.warning(f"Rejected malformed batch feedback: student={student_id}")
+        return jsonify({"success": False, "message": "回饋資料格式錯誤"}), 400
+    logging.info(f"Received batch feedback: student={student_id}, count={len(feedbacks)}")
+
     try:
         with sqlite3.connect(DB_PATH) as conn:
             c = conn.cursor()
@@ -491,7 +672,7 @@ def admin_logout():
 @admin_required
 def admin():
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with snapshot_connection() as conn:
             c = conn.cursor()
             c.execute("SELECT student_id, student_name, student_class FROM students")
             students_raw = c.fetchall()
@@ -508,7 +689,8 @@ def admin():
             logging.info(f"Fetched {len(vote_counts)} vote count records")
     except sqlite3.Error as e:
         logging.error(f"Error fetching admin data: {e}")
-        return render_template("admin.html", students={}, vote_counts_data=[], message="無法載入資料")
+        return render_template("admin.html", students={}, vote_counts_data=[], message="無法載入資料",
+                               snapshot_age=snapshot_age())
 
     groups = load_groups()
     vote_counts_data = []
@@ -518,13 +700,16 @@ def admin():
     vote_counts_data = sorted(vote_counts_data, key=lambda x: x['vote_count'], reverse=True)
     logging.info(f"Prepared {len(vote_counts_data)} vote count entries for display")
 
-    return render_template("admin.html", students=student_votes, vote_counts_data=vote_counts_data)
+    return render_template("admin.html", students=student_votes, vote_counts_data=vote_counts_data,
+                           snapshot_age=snapshot_age())
 
 @app.route("/admin/download_votes")
+@admin_required
 def download_votes():
     groups = load_groups()
+    refresh_snapshot(max_age=DOWNLOAD_SNAPSHOT_MAX_AGE_SECONDS)
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with snapshot_connection() as conn:
             c = conn.cursor()
             c.execute("SELECT student_id, student_name, student_class FROM students")
             students_raw = c.fetchall()
@@ -555,11 +740,13 @@ def download_votes():
                      as_attachment=True, download_name="投票結果.xlsx")
 
 @app.route("/admin/download_student_votes")
+@admin_required
 def download_student_votes():
     groups = load_groups()  # groups.json 的資料
+    refresh_snapshot(max_age=DOWNLOAD_SNAPSHOT_MAX_AGE_SECONDS)
 
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with snapshot_connection() as conn:
             c = conn.cursor()
 
             # 取得 votes 表所有 group_id
@@ -598,9 +785,10 @@ def download_student_votes():
 
 
 @app.route("/admin/feedbacks")
+@admin_required
 def admin_feedbacks():
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with snapshot_connection() as conn:
             c = conn.cursor()
             c.execute('''
                 SELECT f.student_id, s.student_name, s.student_class, f.group_id, g.name, f.feedback, 
@@ -618,7 +806,8 @@ def admin_feedbacks():
                 logging.warning(f"Invalid group_ids found in feedbacks: {invalid_groups}")
     except sqlite3.OperationalError as e:
         logging.error(f"Error querying feedbacks: {e}")
-        return render_template("admin_feedbacks.html", feedbacks=[], message="無法載入回饋資料")
+        return render_template("admin_feedbacks.html", feedbacks=[], message="無法載入回饋資料",
+                               snapshot_age=snapshot_age())
 
     feedbacks = []
     for row in rows:
@@ -635,14 +824,16 @@ def admin_feedbacks():
 
     if not feedbacks:
         logging.info("No feedback records found for admin page.")
-        return render_template("admin_feedbacks.html", feedbacks=[], message="目前沒有回饋資料")
+        return render_template("admin_feedbacks.html", feedbacks=[], message="目前沒有回饋資料",
+                               snapshot_age=snapshot_age())
 
-    return render_template("admin_feedbacks.html", feedbacks=feedbacks)
+    return render_template("admin_feedbacks.html", feedbacks=feedbacks, snapshot_age=snapshot_age())
 
 @app.route('/api/admin/feedbacks', methods=['GET'])
+@admin_required
 def get_feedbacks():
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with snapshot_connection() as conn:
             c = conn.cursor()
             c.execute('''
                 SELECT f.student_id, s.student_name, s.student_class, f.group_id, g.name, f.feedback, 
@@ -676,9 +867,10 @@ def get_feedbacks():
 
     if not feedback_data:
         logging.info("No feedback records found for API.")
-        return jsonify({"success": True, "feedbacks": [], "message": "目前沒有回饋資料"})
+        return jsonify({"success": True, "feedbacks": [], "message": "目前沒有回饋資料",
+                        "snapshotAge": snapshot_age()})
 
-    return jsonify({"success": True, "feedbacks": feedback_data})
+    return jsonify({"success": True, "feedbacks": feedback_data, "snapshotAge": snapshot_age()})
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
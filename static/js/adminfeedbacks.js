@@ -11,6 +11,11 @@ window.onload = function() {
             tbody.innerHTML = "";
 
             if (data.success) {
+                const snapshotAge = document.querySelector(".snapshot-age");
+                if (snapshotAge && data.snapshotAge !== null && data.snapshotAge !== undefined) {
+                    snapshotAge.textContent = `資料快照更新於 ${data.snapshotAge} 秒前`;
+                }
+
                 const feedbacks = data.feedbacks;
                 if (feedbacks.length === 0) {
                     const row = document.createElement("tr");
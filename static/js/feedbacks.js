@@ -60,7 +60,7 @@ document.getElementById("submit_form").addEventListener("submit", function (even
 
   const feedbackData = JSON.stringify(feedbacks);
 
-  fetch("/api/feedback/batch", {
+  fetchWithRetry("/api/feedback/batch", {
     method: "POST",
     body: new URLSearchParams({
       data: feedbackData
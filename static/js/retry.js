@@ -0,0 +1,10 @@
+function fetchWithRetry(url, options, retries = 5) {
+  return fetch(url, options).then(response => {
+    if (response.status === 429 && retries > 0) {
+      const delay = (parseInt(response.headers.get("Retry-After"), 10) || 1) * 1000;
+      return new Promise(resolve => setTimeout(resolve, delay))
+        .then(() => fetchWithRetry(url, options, retries - 1));
+    }
+    return response;
+  });
+}
@@ -51,7 +51,7 @@ document.addEventListener("DOMContentLoaded", function () {
         return;
       }
 
-      fetch("/api/vote/confirm", {
+      fetchWithRetry("/api/vote/confirm", {
         method: "POST",
         headers: {
           "Content-Type": "application/json",